@@ -4,27 +4,55 @@ Provides REST API endpoints for emotion detection and data management
 """
 
 from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import cv2
-import numpy as np
-import base64
+import orjson
+import pybase64
 import os
-from werkzeug.utils import secure_filename
+import uuid
 import logging
 from datetime import datetime
 import threading
+import queue
+import atexit
 import time
+import hashlib
+from collections import OrderedDict
+
+try:
+    import xxhash  # SIMD-accelerated non-cryptographic hashing
+except ImportError:
+    xxhash = None
 
 # Import custom modules
 from emotion_detector import emotion_detector
-from database import emotion_db
+from database import emotion_db, iso_from_ns
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that parses requests and serializes responses with orjson"""
+    
+    # numpy scalars (e.g. DeepFace float32 scores) are serialized natively
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Build the body from orjson's bytes directly, skipping the str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.option | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
@@ -33,7 +61,14 @@ CORS(app)
 
 # Configuration
 UPLOAD_FOLDER = 'static/uploads'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+ALLOWED_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'})
+DEFAULT_JPEG_QUALITY = 75  # for annotated webcam frames
+RAW_IMAGE_MIMETYPES = {'application/octet-stream', 'image/jpeg', 'image/png', 'image/webp'}
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_TTL = 5.0  # seconds
+MAX_RECENT_LIMIT = 1000  # cap for /api/emotions/recent?limit=
+WRITE_BATCH_SIZE = 128  # max records per database write
+WRITE_BATCH_WINDOW = 0.1  # seconds to wait for more records after the first
 
 # Ensure upload directory exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -42,8 +77,123 @@ os.makedirs('static/js', exist_ok=True)
 os.makedirs('templates', exist_ok=True)
 
 def allowed_file(filename):
-    """Check if file extension is allowed"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    """Return the lowercased file extension if it is allowed, otherwise None"""
+    extension = os.path.splitext(filename)[1].lower()
+    return extension if extension in ALLOWED_EXTENSIONS else None
+
+# Background persistence: request threads enqueue jobs, one daemon thread writes them
+write_queue = queue.Queue()
+
+def persistence_worker():
+    """Write queued emotion records off the request thread"""
+    while True:
+        # Block for the first job, then collect more for a short window
+        jobs = [write_queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_WINDOW
+        while len(jobs) < WRITE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        try:
+            records = [payload for kind, payload in jobs if kind == 'record']
+            
+            # One write + fsync for the whole batch of records
+            if records:
+                emotion_db.add_emotion_records(records)
+        except Exception as e:
+            logger.error(f"Error persisting batch: {str(e)}")
+        finally:
+            for _ in jobs:
+                write_queue.task_done()
+
+writer_thread = None
+
+def start_persistence_worker():
+    """Start the writer thread unless one is already running in this process"""
+    global writer_thread
+    if writer_thread is None or not writer_thread.is_alive():
+        writer_thread = threading.Thread(target=persistence_worker, daemon=True)
+        writer_thread.start()
+
+start_persistence_worker()
+# Drain pending writes before the interpreter exits
+atexit.register(write_queue.join)
+
+def image_digest(image_bytes):
+    """Fast 64-bit fingerprint of encoded image bytes, used as a cache key"""
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(image_bytes)
+    return hashlib.blake2b(image_bytes, digest_size=8).digest()
+
+class ResultCache:
+    """
+    Thread-safe cache of detection results that expire after a TTL
+    
+    Entries are kept in insertion order, which is also expiry order, so
+    expired entries are purged from the front on every ``put`` and the
+    oldest entries are evicted first when the cache is full.
+    """
+    
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return the cached value for ``key``, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+    
+    def put(self, key, value):
+        """Store ``value`` under ``key``, dropping expired and then the oldest entries"""
+        with self._lock:
+            now = time.monotonic()
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, value)
+            
+            # Large annotated frames must not outlive their TTL waiting for a read
+            while self._entries:
+                oldest_key, (expires_at, _) = next(iter(self._entries.items()))
+                if expires_at >= now:
+                    break
+                del self._entries[oldest_key]
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+# Identical images (client retries, static webcam scenes) skip the model
+result_cache = ResultCache()
+
+def to_response(result):
+    """
+    Copy a detection result for the JSON response
+    
+    The detector stamps results with an integer ``timestamp_ns``; it is only
+    formatted into the ISO ``timestamp`` clients expect here, once per response.
+    
+    Args:
+        result (dict): Detection result
+        
+    Returns:
+        dict: Response payload
+    """
+    payload = dict(result)
+    timestamp_ns = payload.pop('timestamp_ns', None)
+    if timestamp_ns is not None:
+        payload['timestamp'] = iso_from_ns(timestamp_ns)
+    return payload
 
 @app.route('/')
 def index():
@@ -55,6 +205,9 @@ def detect_emotion():
     """
     Detect emotion from uploaded image
     
+    The image is analyzed in memory; it is only written to the upload
+    folder when the request passes ``?save=1``.
+    
     Returns:
         JSON response with emotion detection results
     """
@@ -66,35 +219,43 @@ def detect_emotion():
         if file.filename == '':
             return jsonify({'success': False, 'error': 'No file selected'}), 400
         
-        if file and allowed_file(file.filename):
-            # Save uploaded file
-            filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{timestamp}_{filename}"
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            file.save(filepath)
+        extension = allowed_file(file.filename) if file else None
+        if extension:
+            image_bytes = file.read()
             
-            # Detect emotion
-            result = emotion_detector.detect_emotion_from_image(filepath)
+            cache_key = ('upload', image_digest(image_bytes))
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                result = dict(cached, cache_hit=True, timestamp_ns=time.time_ns())
+            else:
+                # Detect emotion straight from the uploaded bytes
+                result = emotion_detector.detect_emotion_from_bytes(image_bytes)
+                if result['success']:
+                    result_cache.put(cache_key, dict(result))
             
             if result['success']:
-                # Add source and image path info
+                # Add source info
                 result['source'] = 'upload'
-                result['image_path'] = filepath
-                result['filename'] = filename
                 
-                # Convert numpy float32 to regular Python float for JSON serialization
-                if 'emotions' in result:
-                    result['emotions'] = {k: float(v) for k, v in result['emotions'].items()}
+                # Keep the image only when explicitly requested; written before
+                # responding, since the response points clients at the file
+                if request.args.get('save') == '1':
+                    # Opaque name: no user-controlled path components, no collisions
+                    filename = f"{uuid.uuid4().hex}{extension}"
+                    filepath = os.path.join(UPLOAD_FOLDER, filename)
+                    with open(filepath, 'wb') as f:
+                        f.write(image_bytes)
+                    result['image_path'] = filepath
+                    result['filename'] = filename
                 
                 # Save to database
-                emotion_db.add_emotion_record(result)
+                write_queue.put_nowait(('record', result))
                 
                 logger.info(f"Emotion detected from uploaded image: {result['dominant_emotion']}")
                 
-                return jsonify(result)
+                return jsonify(to_response(result))
             else:
-                return jsonify(result), 500
+                return jsonify(to_response(result)), 500
         
         return jsonify({'success': False, 'error': 'Invalid file type'}), 400
         
@@ -105,31 +266,67 @@ def detect_emotion():
 @app.route('/api/detect_emotion_webcam', methods=['POST'])
 def detect_emotion_webcam():
     """
-    Detect emotion from webcam frame (base64 image)
+    Detect emotion from webcam frame
+    
+    Accepts either a JSON body with a base64 (data URL) ``image`` field, or
+    the raw encoded frame as the request body (``application/octet-stream``
+    or ``image/*``) with options passed as query parameters.
+    
+    The annotated frame is only JPEG-encoded and returned as
+    ``annotated_frame_base64`` when the request sets ``return_annotated``;
+    ``jpeg_quality`` (default 75) controls its encoding quality.
+    
+    Clients streaming frames may pass a ``stream_id`` to let the detector
+    reuse that stream's recent result for skipped frames when it runs with a
+    ``frame_stride`` above 1. Frames saved with ``save_to_db`` are always
+    analyzed themselves.
     
     Returns:
         JSON response with emotion detection results
     """
     try:
-        data = request.get_json()
-        
-        if not data or 'image' not in data:
-            return jsonify({'success': False, 'error': 'No image data provided'}), 400
-        
-        # Decode base64 image
-        image_data = data['image']
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
+        if request.mimetype in RAW_IMAGE_MIMETYPES:
+            # Raw binary frame: no base64 decoding needed
+            image_data = None
+            image_bytes = request.get_data(cache=False)
+            data = {
+                'return_annotated': request.args.get('return_annotated', '0').lower() in ('1', 'true'),
+                'save_to_db': request.args.get('save_to_db', '0').lower() in ('1', 'true'),
+                'jpeg_quality': request.args.get('jpeg_quality', DEFAULT_JPEG_QUALITY, type=int),
+                'stream_id': request.args.get('stream_id')
+            }
+            if not image_bytes:
+                return jsonify({'success': False, 'error': 'No image data provided'}), 400
+        else:
+            data = request.get_json()
+            
+            if not data or 'image' not in data:
+                return jsonify({'success': False, 'error': 'No image data provided'}), 400
+            
+            # Skip a data URL header if present; it is short, so bound the search
+            image_data = data['image']
+            if image_data.startswith('data:'):
+                image_data = image_data[image_data.find(',', 0, 64) + 1:]
         
-        # Convert to numpy array
         try:
-            image_bytes = base64.b64decode(image_data)
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            if image_data is not None:
+                image_bytes = pybase64.b64decode(image_data, validate=False)
         except Exception as decode_error:
             logger.error(f"Image decode error: {decode_error}")
             return jsonify({'success': False, 'error': f'Image decode failed: {str(decode_error)}'}), 400
         
+        # Look up the encoded bytes before paying for the JPEG decode
+        cache_key = ('webcam', image_digest(image_bytes),
+                     bool(data.get('return_annotated', False)), data.get('jpeg_quality'))
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            result = dict(cached, cache_hit=True, timestamp_ns=time.time_ns())
+            if data.get('save_to_db', False):
+                write_queue.put_nowait(('record', result))
+            return jsonify(to_response(result))
+        
+        # Convert to numpy array
+        frame = emotion_detector.decode_image_bytes(image_bytes)
         if frame is None:
             return jsonify({'success': False, 'error': 'Invalid image data - could not decode frame'}), 400
         
@@ -137,8 +334,12 @@ def detect_emotion_webcam():
         
         # Check if emotion_detector is available
         try:
-            # Detect emotion
-            result = emotion_detector.detect_emotion_from_frame(frame)
+            # Detect emotion; never store a result reused from an earlier frame
+            stream_id = None if data.get('save_to_db', False) else data.get('stream_id')
+            result = emotion_detector.detect_emotion_from_frame(
+                frame, annotate=bool(data.get('return_annotated', False)),
+                stream_id=None if stream_id is None else str(stream_id)
+            )
             logger.info(f"Emotion detection result: {result.get('success', False)}")
             
         except Exception as detection_error:
@@ -161,39 +362,36 @@ def detect_emotion_webcam():
                 'error_details': str(detection_error)
             })
         
+        # Take the numpy frame out of the result; it is never sent as-is
+        annotated_frame = result.pop('annotated_frame', None)
+        
         if result['success']:
-            # Convert annotated frame back to base64 (if available)
-            if 'annotated_frame' in result:
+            # The detector keeps scores as an array; label them for the response
+            result['emotions'] = emotion_detector.emotions_to_dict(result['emotions'])
+            
+            # Convert annotated frame back to base64 only when the client asks for it
+            if annotated_frame is not None and data.get('return_annotated', False):
                 try:
-                    _, buffer = cv2.imencode('.jpg', result['annotated_frame'])
-                    frame_base64 = base64.b64encode(buffer).decode('utf-8')
+                    jpeg_quality = int(data.get('jpeg_quality', DEFAULT_JPEG_QUALITY))
+                    buffer = emotion_detector.encode_jpeg(annotated_frame, jpeg_quality)
+                    frame_base64 = pybase64.b64encode(buffer).decode('ascii')
                     result['annotated_frame_base64'] = f"data:image/jpeg;base64,{frame_base64}"
-                    
-                    # Remove numpy array from response (not JSON serializable)
-                    del result['annotated_frame']
                 except Exception as frame_error:
                     logger.warning(f"Frame encoding error: {frame_error}")
-                    # Remove the problematic field
-                    if 'annotated_frame' in result:
-                        del result['annotated_frame']
             
             # Add source info
             result['source'] = 'webcam'
-            
-            # Convert numpy float32 to regular Python float for JSON serialization
-            if 'emotions' in result:
-                result['emotions'] = {k: float(v) for k, v in result['emotions'].items()}
+            if not result.get('reused'):
+                # A reused result belongs to an earlier frame, not to these bytes
+                result_cache.put(cache_key, dict(result))
             
             # Save to database (optional for webcam, can be disabled for performance)
             if data.get('save_to_db', False):
-                try:
-                    emotion_db.add_emotion_record(result)
-                except Exception as db_error:
-                    logger.warning(f"Database save error: {db_error}")
+                write_queue.put_nowait(('record', result))
             
-            return jsonify(result)
+            return jsonify(to_response(result))
         else:
-            return jsonify(result), 500
+            return jsonify(to_response(result)), 500
         
     except Exception as e:
         logger.error(f"Error in detect_emotion_webcam: {str(e)}")
@@ -203,7 +401,8 @@ def detect_emotion_webcam():
 def get_recent_emotions():
     """Get recent emotion detection records"""
     try:
-        limit = request.args.get('limit', 10, type=int)
+        # Clamp client-supplied limits to a sane range
+        limit = max(1, min(request.args.get('limit', 10, type=int), MAX_RECENT_LIMIT))
         emotions = emotion_db.get_recent_emotions(limit)
         return jsonify({'success': True, 'emotions': emotions})
         
@@ -310,7 +509,12 @@ def internal_error(e):
     return jsonify({'success': False, 'error': 'Internal server error'}), 500
 
 def preload_models():
-    """Preload models in a separate thread"""
+    """
+    Preload models in a separate thread
+    
+    emotion_detector already preloads at import unless EMOTION_SKIP_PRELOAD=1;
+    in that case this finishes the job, otherwise it returns immediately.
+    """
     def load():
         logger.info("Starting model preloading...")
         emotion_detector.preload_models()
@@ -1,61 +1,271 @@
 """
 JSON Database Module for Emotion Recognition System
 Handles storage and retrieval of emotion detection results
+
+Records are stored append-only, one JSON object per line (JSONL), so adding
+a record never re-serializes the existing history. Aggregate statistics are
+kept in memory and persisted to a small separate JSON file.
 """
 
-import json
+import csv
+import orjson
 import os
-from datetime import datetime
+import itertools
+import atexit
+import threading
+import time
 import logging
-from typing import Dict, List, Optional
+from collections import defaultdict, deque
+from typing import Dict, Iterator, List, Optional, Tuple
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+EMOTION_TYPES = ['happy', 'sad', 'angry', 'surprise', 'neutral', 'disgust', 'fear']
+# Record fields in stored order, used for CSV export columns
+CSV_RECORD_FIELDS = ['id', 'timestamp', 'dominant_emotion', 'emotions', 'confidence',
+                     'source', 'face_detected', 'face_region', 'image_path']
+
+# Directories already created (or confirmed) by _ensure_dir
+_ensured_dirs = set()
+
+def _ensure_dir(path: str):
+    """Create a directory once per process, skipping the syscalls afterwards"""
+    if not path or path in _ensured_dirs:
+        return
+    os.makedirs(path, exist_ok=True)
+    _ensured_dirs.add(path)
+
+# (epoch second, formatted 'YYYY-MM-DDTHH:MM:SS') of the last now_iso() call
+_iso_second_cache = (None, '')
+
+def iso_from_ns(timestamp_ns: int) -> str:
+    """
+    Format a ``time.time_ns()`` value as a local ISO 8601 string with microseconds
+    
+    Same format as ``datetime.isoformat()``, but the date and time part is
+    only formatted once per second.
+    
+    Args:
+        timestamp_ns (int): Nanoseconds since the epoch
+        
+    Returns:
+        str: Formatted timestamp
+    """
+    global _iso_second_cache
+    seconds, nanoseconds = divmod(timestamp_ns, 1_000_000_000)
+    cached_second, prefix = _iso_second_cache
+    if seconds != cached_second:
+        prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(seconds))
+        _iso_second_cache = (seconds, prefix)
+    return f"{prefix}.{nanoseconds // 1000:06d}"
+
+def now_iso() -> str:
+    """
+    Get the current local time as an ISO 8601 string with microseconds
+    
+    Returns:
+        str: Current timestamp
+    """
+    return iso_from_ns(time.time_ns())
+
 class EmotionDatabase:
-    def __init__(self, db_path='data/emotions.json'):
+    # Number of inserts between statistics file flushes
+    STATS_FLUSH_INTERVAL = 20
+    # Block size used when scanning the records file backwards
+    TAIL_BLOCK_SIZE = 8192
+    # Number of most recent records mirrored in memory
+    RECENT_CACHE_SIZE = 10_000
+
+    def __init__(self, db_path='data/emotions.jsonl', stats_path='data/statistics.json'):
         """
         Initialize the JSON database
         
         Args:
-            db_path (str): Path to the JSON database file
+            db_path (str): Path to the JSONL records file
+            stats_path (str): Path to the JSON statistics file
         """
         self.db_path = db_path
+        self.stats_path = stats_path
         self.ensure_database_exists()
+        
+        self._stats = self.load_statistics()
+        self._unflushed_inserts = 0
+        
+        # Computed statistics (with percentages), rebuilt only after writes
+        self._stats_cache = None
+        self._stats_dirty = True
+        # Flask serves requests from multiple threads
+        self._lock = threading.Lock()
+        
+        # Unbuffered append handle: each record is a single write() call
+        self._records_file = open(self.db_path, 'ab', buffering=0)
+        # Separate read handle for fetching indexed records by offset
+        self._reader = open(self.db_path, 'rb', buffering=0)
+        self._reader_lock = threading.Lock()
+        
+        # In-memory indices: key -> [(byte offset, length), ...] in insertion order
+        self._date_index = defaultdict(list)
+        self._emotion_index = defaultdict(list)
+        self._end_offset = 0
+        # Bounded mirror of the newest records, oldest first
+        self._recent = deque(maxlen=self.RECENT_CACHE_SIZE)
+        self._build_indices()
+        
+        # Continue numbering after the last persisted record
+        next_id = self._recent[-1].get('id', 0) + 1 if self._recent else 1
+        self._id_counter = itertools.count(next_id)
+        
+        atexit.register(self.flush_statistics)
+    
+    @staticmethod
+    def _initial_statistics() -> Dict:
+        """Build an empty statistics structure"""
+        now = now_iso()
+        return {
+            'total_detections': 0,
+            'emotion_counts': {emotion: 0 for emotion in EMOTION_TYPES},
+            'created_at': now,
+            'last_updated': now
+        }
+    
+    @staticmethod
+    def _encode_record(record: Dict) -> bytes:
+        """Serialize a record as a single JSONL line"""
+        # numpy scalars from the detector are serialized natively
+        return orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
     
     def ensure_database_exists(self):
-        """Create database file and directory if they don't exist"""
+        """Create database files and directory if they don't exist"""
         try:
             # Create data directory if it doesn't exist
-            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            _ensure_dir(os.path.dirname(self.db_path))
             
-            # Create database file if it doesn't exist
             if not os.path.exists(self.db_path):
-                initial_data = {
-                    'emotions': [],
-                    'statistics': {
-                        'total_detections': 0,
-                        'emotion_counts': {
-                            'happy': 0,
-                            'sad': 0,
-                            'angry': 0,
-                            'surprise': 0,
-                            'neutral': 0,
-                            'disgust': 0,
-                            'fear': 0
-                        },
-                        'created_at': datetime.now().isoformat(),
-                        'last_updated': datetime.now().isoformat()
-                    }
-                }
-                self.save_data(initial_data)
-                logger.info(f"Created new database at {self.db_path}")
+                # Migrate a legacy single-document JSON database if one is present
+                legacy_path = os.path.splitext(self.db_path)[0] + '.json'
+                if legacy_path != self.db_path and os.path.exists(legacy_path):
+                    with open(legacy_path, 'rb') as f:
+                        legacy_data = orjson.loads(f.read())
+                    self.save_data(legacy_data)
+                    logger.info(f"Migrated legacy database {legacy_path} to {self.db_path}")
+                else:
+                    self.save_data({'emotions': [], 'statistics': self._initial_statistics()})
+                    logger.info(f"Created new database at {self.db_path}")
+            
+            elif not os.path.exists(self.stats_path):
+                self.save_statistics(self._initial_statistics())
             
         except Exception as e:
             logger.error(f"Error creating database: {str(e)}")
             raise
     
+    def _iter_records(self) -> Iterator[Dict]:
+        """
+        Iterate over all stored records in insertion order
+        
+        Yields:
+            dict: Emotion record
+        """
+        with open(self.db_path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+    
+    def _index_record(self, record: Dict, offset: int, length: int):
+        """Add a record's byte span to the date and emotion indices"""
+        span = (offset, length)
+        self._date_index[record.get('timestamp', '').split('T')[0]].append(span)
+        self._emotion_index[record.get('dominant_emotion', '').lower()].append(span)
+    
+    def _build_indices(self):
+        """
+        Scan the records file once to build the lookup indices and recent cache
+        
+        Detection counts are recomputed from the records during the same scan,
+        so statistics missing inserts since their last flush (e.g. after a
+        crash) or a missing statistics file are repaired at startup.
+        """
+        offset = 0
+        total_detections = 0
+        emotion_counts = {emotion: 0 for emotion in EMOTION_TYPES}
+        last_updated = None
+        with open(self.db_path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    record = orjson.loads(line)
+                    self._index_record(record, offset, len(line))
+                    self._recent.append(record)
+                    if record.get('face_detected', False):
+                        total_detections += 1
+                        dominant_emotion = record.get('dominant_emotion', 'neutral')
+                        if dominant_emotion in emotion_counts:
+                            emotion_counts[dominant_emotion] += 1
+                        last_updated = record.get('timestamp', last_updated)
+                offset += len(line)
+        self._end_offset = offset
+        
+        if (self._stats.get('total_detections') != total_detections
+                or self._stats.get('emotion_counts') != emotion_counts):
+            logger.info("Statistics out of date with the records file, rebuilt them")
+            self._stats['total_detections'] = total_detections
+            self._stats['emotion_counts'] = emotion_counts
+            if last_updated is not None:
+                self._stats['last_updated'] = last_updated
+            self._stats_dirty = True
+            try:
+                self.save_statistics(self._stats)
+            except Exception as e:
+                logger.error(f"Error saving rebuilt statistics: {str(e)}")
+    
+    def _read_span(self, offset: int, length: int) -> bytes:
+        """Read raw bytes of one record without touching the file position"""
+        if hasattr(os, 'pread'):
+            return os.pread(self._reader.fileno(), length, offset)
+        # Windows has no pread; fall back to a serialized seek + read
+        with self._reader_lock:
+            self._reader.seek(offset)
+            return self._reader.read(length)
+    
+    def _fetch_records(self, spans: List[Tuple[int, int]]) -> List[Dict]:
+        """
+        Load records by their byte spans in the records file
+        
+        Args:
+            spans (list): (offset, length) pairs from an index
+            
+        Returns:
+            list: Decoded emotion records
+        """
+        return [orjson.loads(self._read_span(offset, length)) for offset, length in spans]
+    
+    def _read_tail(self, limit: int) -> List[Dict]:
+        """
+        Read the last records by scanning the file backwards from the end
+        
+        Args:
+            limit (int): Number of records to read
+            
+        Returns:
+            list: Up to ``limit`` records, oldest first
+        """
+        if limit <= 0:
+            return []
+        
+        with open(self.db_path, 'rb') as f:
+            pos = f.seek(0, os.SEEK_END)
+            chunk = b''
+            # One extra newline guarantees the first line in the chunk is whole
+            while pos > 0 and chunk.count(b'\n') <= limit:
+                step = min(self.TAIL_BLOCK_SIZE, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step) + chunk
+        
+        lines = [line for line in chunk.splitlines() if line.strip()]
+        return [orjson.loads(line) for line in lines[-limit:]]
+    
     def load_data(self) -> Dict:
         """
         Load data from JSON database
@@ -64,26 +274,87 @@ class EmotionDatabase:
             dict: Database contents
         """
         try:
-            with open(self.db_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return {'emotions': list(self._iter_records()), 'statistics': self.load_statistics()}
         except Exception as e:
             logger.error(f"Error loading database: {str(e)}")
             return {'emotions': [], 'statistics': {}}
     
     def save_data(self, data: Dict):
         """
-        Save data to JSON database
+        Save data to JSON database, replacing all existing records
         
         Args:
             data (dict): Data to save
         """
         try:
-            with open(self.db_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            with open(self.db_path, 'wb') as f:
+                for record in data.get('emotions', []):
+                    f.write(self._encode_record(record))
+            self.save_statistics(data.get('statistics') or self._initial_statistics())
         except Exception as e:
             logger.error(f"Error saving database: {str(e)}")
             raise
     
+    def load_statistics(self) -> Dict:
+        """
+        Load persisted statistics
+        
+        Returns:
+            dict: Statistics data
+        """
+        try:
+            with open(self.stats_path, 'rb') as f:
+                return orjson.loads(f.read())
+        except Exception as e:
+            logger.error(f"Error loading statistics: {str(e)}")
+            return self._initial_statistics()
+    
+    def save_statistics(self, stats: Dict):
+        """
+        Atomically write statistics to disk
+        
+        Args:
+            stats (dict): Statistics to save
+        """
+        tmp_path = self.stats_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(stats, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+        os.replace(tmp_path, self.stats_path)
+    
+    def _flush_statistics_unlocked(self):
+        """Persist statistics; caller must hold ``self._lock``"""
+        if self._unflushed_inserts == 0:
+            return
+        try:
+            self.save_statistics(self._stats)
+            self._unflushed_inserts = 0
+        except Exception as e:
+            logger.error(f"Error flushing statistics: {str(e)}")
+    
+    def flush_statistics(self):
+        """Persist in-memory statistics if there are unflushed inserts"""
+        with self._lock:
+            self._flush_statistics_unlocked()
+    
+    @staticmethod
+    def _build_record(emotion_data: Dict) -> Dict:
+        """Create a stored emotion record from detection results (id assigned later)"""
+        return {
+            'id': None,
+            # Detection time when the detector recorded one, else insertion time
+            'timestamp': (iso_from_ns(emotion_data['timestamp_ns'])
+                          if 'timestamp_ns' in emotion_data else now_iso()),
+            'dominant_emotion': emotion_data.get('dominant_emotion', 'unknown'),
+            'emotions': emotion_data.get('emotions', {}),
+            'confidence': emotion_data.get('emotions', {}).get(
+                emotion_data.get('dominant_emotion', 'neutral'), 0
+            ),
+            'source': emotion_data.get('source', 'unknown'),  # 'webcam' or 'upload'
+            'face_detected': emotion_data.get('success', False),
+            'face_region': emotion_data.get('face_region', {}),
+            'image_path': emotion_data.get('image_path', None)
+        }
+    
     def add_emotion_record(self, emotion_data: Dict) -> bool:
         """
         Add a new emotion detection record
@@ -94,46 +365,67 @@ class EmotionDatabase:
         Returns:
             bool: Success status
         """
-        try:
-            data = self.load_data()
-            
-            # Create emotion record
-            record = {
-                'id': len(data['emotions']) + 1,
-                'timestamp': datetime.now().isoformat(),
-                'dominant_emotion': emotion_data.get('dominant_emotion', 'unknown'),
-                'emotions': emotion_data.get('emotions', {}),
-                'confidence': emotion_data.get('emotions', {}).get(
-                    emotion_data.get('dominant_emotion', 'neutral'), 0
-                ),
-                'source': emotion_data.get('source', 'unknown'),  # 'webcam' or 'upload'
-                'face_detected': emotion_data.get('success', False),
-                'face_region': emotion_data.get('face_region', {}),
-                'image_path': emotion_data.get('image_path', None)
-            }
+        return self.add_emotion_records([emotion_data]) == 1
+    
+    def add_emotion_records(self, emotion_data_list: List[Dict]) -> int:
+        """
+        Add several emotion detection records with a single write and fsync
+        
+        Args:
+            emotion_data_list (list): Emotion detection results
             
-            # Add record to emotions list
-            data['emotions'].append(record)
+        Returns:
+            int: Number of records added
+        """
+        if not emotion_data_list:
+            return 0
+        
+        try:
+            records = [self._build_record(emotion_data) for emotion_data in emotion_data_list]
             
-            # Update statistics
-            if emotion_data.get('success', False):
-                dominant_emotion = emotion_data.get('dominant_emotion', 'neutral')
-                data['statistics']['total_detections'] += 1
+            with self._lock:
+                lines = []
+                for record in records:
+                    record['id'] = next(self._id_counter)
+                    lines.append(self._encode_record(record))
+                
+                # Append all records to the records file at once
+                self._records_file.write(b''.join(lines))
+                os.fsync(self._records_file.fileno())
                 
-                if dominant_emotion in data['statistics']['emotion_counts']:
-                    data['statistics']['emotion_counts'][dominant_emotion] += 1
+                for record, line, emotion_data in zip(records, lines, emotion_data_list):
+                    # Index the record's position
+                    self._index_record(record, self._end_offset, len(line))
+                    self._end_offset += len(line)
+                    self._recent.append(record)
+                    
+                    # Update statistics
+                    if emotion_data.get('success', False):
+                        dominant_emotion = emotion_data.get('dominant_emotion', 'neutral')
+                        self._stats['total_detections'] += 1
+                        
+                        if dominant_emotion in self._stats['emotion_counts']:
+                            self._stats['emotion_counts'][dominant_emotion] += 1
+                        
+                        self._stats['last_updated'] = record['timestamp']
+                        self._stats_dirty = True
                 
-                data['statistics']['last_updated'] = datetime.now().isoformat()
+                # Persist statistics periodically rather than on every insert
+                self._unflushed_inserts += len(records)
+                if self._unflushed_inserts >= self.STATS_FLUSH_INTERVAL:
+                    self._flush_statistics_unlocked()
             
-            # Save updated data
-            self.save_data(data)
-            logger.info(f"Added emotion record with ID: {record['id']}")
+            if len(records) == 1:
+                logger.info(f"Added emotion record with ID: {records[0]['id']}")
+            else:
+                logger.info(f"Added {len(records)} emotion records with IDs "
+                            f"{records[0]['id']}-{records[-1]['id']}")
             
-            return True
+            return len(records)
             
         except Exception as e:
-            logger.error(f"Error adding emotion record: {str(e)}")
-            return False
+            logger.error(f"Error adding emotion records: {str(e)}")
+            return 0
     
     def get_recent_emotions(self, limit: int = 10) -> List[Dict]:
         """
@@ -146,11 +438,19 @@ class EmotionDatabase:
             list: Recent emotion records
         """
         try:
-            data = self.load_data()
-            emotions = data.get('emotions', [])
+            with self._lock:
+                # The cache mirrors every non-empty database, so empty means no records
+                if limit <= 0 or not self._recent:
+                    return []
+                
+                # The in-memory tail covers the request unless older records were evicted
+                if limit <= len(self._recent) or len(self._recent) < self._recent.maxlen:
+                    recent = list(itertools.islice(reversed(self._recent), limit))
+                    recent.reverse()
+                    return recent
             
-            # Return most recent records
-            return emotions[-limit:] if len(emotions) > limit else emotions
+            # Only the tail of the file is read and parsed
+            return self._read_tail(limit)
             
         except Exception as e:
             logger.error(f"Error getting recent emotions: {str(e)}")
@@ -160,23 +460,32 @@ class EmotionDatabase:
         """
         Get emotion detection statistics
         
+        The returned dict is cached and shared between callers until the
+        next write, so it must not be modified.
+        
         Returns:
             dict: Statistics data
         """
         try:
-            data = self.load_data()
-            stats = data.get('statistics', {})
-            
-            # Calculate percentages
-            total = stats.get('total_detections', 0)
-            if total > 0:
-                emotion_percentages = {}
-                for emotion, count in stats.get('emotion_counts', {}).items():
-                    emotion_percentages[emotion] = round((count / total) * 100, 2)
+            with self._lock:
+                if not self._stats_dirty and self._stats_cache is not None:
+                    return self._stats_cache
                 
-                stats['emotion_percentages'] = emotion_percentages
-            
-            return stats
+                stats = dict(self._stats)
+                stats['emotion_counts'] = dict(self._stats.get('emotion_counts', {}))
+                
+                # Calculate percentages
+                total = stats.get('total_detections', 0)
+                if total > 0:
+                    emotion_percentages = {}
+                    for emotion, count in stats['emotion_counts'].items():
+                        emotion_percentages[emotion] = round((count / total) * 100, 2)
+                    
+                    stats['emotion_percentages'] = emotion_percentages
+                
+                self._stats_cache = stats
+                self._stats_dirty = False
+                return stats
             
         except Exception as e:
             logger.error(f"Error getting statistics: {str(e)}")
@@ -193,16 +502,10 @@ class EmotionDatabase:
             list: Emotion records for the specified date
         """
         try:
-            data = self.load_data()
-            emotions = data.get('emotions', [])
-            
-            filtered_emotions = []
-            for emotion in emotions:
-                emotion_date = emotion.get('timestamp', '').split('T')[0]
-                if emotion_date == date_str:
-                    filtered_emotions.append(emotion)
+            with self._lock:
+                spans = list(self._date_index.get(date_str, ()))
             
-            return filtered_emotions
+            return self._fetch_records(spans)
             
         except Exception as e:
             logger.error(f"Error getting emotions by date: {str(e)}")
@@ -219,15 +522,10 @@ class EmotionDatabase:
             list: Matching emotion records
         """
         try:
-            data = self.load_data()
-            emotions = data.get('emotions', [])
+            with self._lock:
+                spans = list(self._emotion_index.get(emotion_type.lower(), ()))
             
-            filtered_emotions = []
-            for emotion in emotions:
-                if emotion.get('dominant_emotion', '').lower() == emotion_type.lower():
-                    filtered_emotions.append(emotion)
-            
-            return filtered_emotions
+            return self._fetch_records(spans)
             
         except Exception as e:
             logger.error(f"Error searching emotions: {str(e)}")
@@ -241,25 +539,21 @@ class EmotionDatabase:
             bool: Success status
         """
         try:
-            initial_data = {
-                'emotions': [],
-                'statistics': {
-                    'total_detections': 0,
-                    'emotion_counts': {
-                        'happy': 0,
-                        'sad': 0,
-                        'angry': 0,
-                        'surprise': 0,
-                        'neutral': 0,
-                        'disgust': 0,
-                        'fear': 0
-                    },
-                    'created_at': datetime.now().isoformat(),
-                    'last_updated': datetime.now().isoformat()
-                }
-            }
+            with self._lock:
+                # Truncate in place; the append handle keeps writing at the new end
+                os.ftruncate(self._records_file.fileno(), 0)
+                
+                self._stats = self._initial_statistics()
+                self.save_statistics(self._stats)
+                self._unflushed_inserts = 0
+                self._stats_dirty = True
+                self._id_counter = itertools.count(1)
+                
+                self._date_index.clear()
+                self._emotion_index.clear()
+                self._end_offset = 0
+                self._recent.clear()
             
-            self.save_data(initial_data)
             logger.info("Database cleared successfully")
             return True
             
@@ -278,29 +572,30 @@ class EmotionDatabase:
             bool: Success status
         """
         try:
-            import pandas as pd
-            
-            data = self.load_data()
-            emotions = data.get('emotions', [])
-            
-            if not emotions:
+            if self._end_offset == 0:
                 logger.warning("No emotion data to export")
                 return False
             
-            # Convert to DataFrame
-            df = pd.DataFrame(emotions)
-            
-            # Flatten emotions dictionary into separate columns
-            if 'emotions' in df.columns:
-                emotions_df = pd.json_normalize(df['emotions'])
-                emotions_df.columns = [f'emotion_{col}' for col in emotions_df.columns]
-                df = pd.concat([df.drop('emotions', axis=1), emotions_df], axis=1)
-            
-            # Save to CSV
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            df.to_csv(output_path, index=False)
-            
-            logger.info(f"Exported {len(emotions)} records to {output_path}")
+            # Flatten the emotions dictionary into one column per emotion
+            base_fields = [field for field in CSV_RECORD_FIELDS if field != 'emotions']
+            fieldnames = base_fields + [f'emotion_{emotion}' for emotion in EMOTION_TYPES]
+            
+            _ensure_dir(os.path.dirname(output_path))
+            
+            # Stream records line by line so memory use stays constant
+            exported = 0
+            with open(output_path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+                writer.writeheader()
+                for record in self._iter_records():
+                    row = {field: record.get(field) for field in base_fields}
+                    row['face_region'] = orjson.dumps(record.get('face_region') or {}).decode('utf-8')
+                    for emotion, score in (record.get('emotions') or {}).items():
+                        row[f'emotion_{emotion}'] = score
+                    writer.writerow(row)
+                    exported += 1
+            
+            logger.info(f"Exported {exported} records to {output_path}")
             return True
             
         except Exception as e:
@@ -10,6 +10,29 @@ import time
 import json
 from datetime import datetime
 
+def existing_paths(paths):
+    """
+    Find which of the given paths exist, listing each parent directory once
+    
+    Args:
+        paths (list): Relative file or directory paths
+        
+    Returns:
+        set: The paths that exist
+    """
+    listings = {}
+    found = set()
+    for path in paths:
+        parent, name = os.path.split(path.rstrip('/'))
+        if parent not in listings:
+            try:
+                listings[parent] = {entry.name for entry in os.scandir(parent or '.')}
+            except OSError:
+                listings[parent] = set()
+        if name in listings[parent]:
+            found.add(path)
+    return found
+
 def print_demo_header():
     """Print demo header"""
     header = """
@@ -73,7 +96,7 @@ def demo_database():
         stats = emotion_db.get_emotion_statistics()
         total_detections = stats.get('total_detections', 0)
         
-        print(f"   Database file: data/emotions.json")
+        print(f"   Database file: {emotion_db.db_path}")
         print(f"   Total detections: {total_detections}")
         
         if total_detections > 0:
@@ -108,11 +131,15 @@ def demo_database():
                 }
             ]
             
-            for record in sample_records:
-                emotion_db.add_emotion_record(record)
+            # One append and flush for the whole batch
+            added = emotion_db.add_emotion_records(sample_records)
+            for record in sample_records[:added]:
                 print(f"     ✅ Added {record['dominant_emotion']} detection")
             
-            print(f"   Sample data created successfully!")
+            if added:
+                print(f"   Sample data created successfully!")
+            else:
+                print(f"   ⚠️  No sample records were saved. Check the logs for database errors")
         
         return True
         
@@ -249,15 +276,17 @@ def demo_project_structure():
         "Core Files": ["app.py", "emotion_detector.py", "database.py"],
         "Frontend": ["templates/index.html", "static/css/style.css", "static/js/main.js"],
         "R Analytics": ["r_scripts/emotion_analysis.R", "r_scripts/image_experiments.R", "r_scripts/data_visualization.R"],
-        "Data": ["data/emotions.json", "data/sample_images/"],
+        "Data": ["data/emotions.jsonl", "data/statistics.json", "data/sample_images/"],
         "Documentation": ["README.md", "INSTALLATION_GUIDE.md", "requirements.txt"]
     }
     
+    present = existing_paths([file for files in structure.values() for file in files])
+    
     print("✅ Project organization:")
     for category, files in structure.items():
         print(f"\n   📂 {category}:")
         for file in files:
-            exists = "✅" if os.path.exists(file) else "❌"
+            exists = "✅" if file in present else "❌"
             print(f"     {exists} {file}")
 
 def run_quick_test():
@@ -280,21 +309,22 @@ def run_quick_test():
     try:
         from database import emotion_db
         stats = emotion_db.get_emotion_statistics()
-        tests.append(("Database connection", True, "JSON database accessible"))
+        tests.append(("Database connection", True, "JSONL database accessible"))
     except Exception as e:
         tests.append(("Database connection", False, f"Database error: {e}"))
     
     # Test 3: Directory structure
     required_dirs = ["data", "static", "templates", "r_scripts"]
-    missing_dirs = [d for d in required_dirs if not os.path.exists(d)]
+    config_files = ["requirements.txt", "README.md"]
+    present = existing_paths(required_dirs + config_files)
+    missing_dirs = [d for d in required_dirs if d not in present]
     if not missing_dirs:
         tests.append(("Directory structure", True, "All required directories exist"))
     else:
         tests.append(("Directory structure", False, f"Missing: {missing_dirs}"))
     
     # Test 4: Configuration files
-    config_files = ["requirements.txt", "README.md"]
-    missing_files = [f for f in config_files if not os.path.exists(f)]
+    missing_files = [f for f in config_files if f not in present]
     if not missing_files:
         tests.append(("Configuration files", True, "All config files present"))
     else:
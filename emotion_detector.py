@@ -6,47 +6,675 @@ Uses DeepFace library with pre-trained models for emotion detection
 import cv2
 import numpy as np
 from deepface import DeepFace
-import base64
-from PIL import Image
-import io
+import pybase64
 import logging
-from datetime import datetime
 import os
+import math
+import time
+import importlib.util
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict
+
+try:
+    import simplejpeg  # libjpeg-turbo bindings
+except ImportError:
+    simplejpeg = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _top3_kernel(probs):
+    """
+    Indices of the three largest scores, highest first
+    
+    Args:
+        probs (numpy.ndarray): 1-D float32 scores with at least 3 entries
+        
+    Returns:
+        numpy.ndarray: int64 indices of shape (3,)
+    """
+    # Order the first three, then insert the rest
+    i0, i1, i2 = 0, 1, 2
+    if probs[i1] > probs[i0]:
+        i0, i1 = i1, i0
+    if probs[i2] > probs[i1]:
+        i1, i2 = i2, i1
+        if probs[i1] > probs[i0]:
+            i0, i1 = i1, i0
+    for i in range(3, probs.shape[0]):
+        v = probs[i]
+        if v > probs[i0]:
+            i0, i1, i2 = i, i0, i1
+        elif v > probs[i1]:
+            i1, i2 = i, i1
+        elif v > probs[i2]:
+            i2 = i
+    
+    out = np.empty(3, dtype=np.int64)
+    out[0], out[1], out[2] = i0, i1, i2
+    return out
+
+def _top3_numpy(probs):
+    """Fallback for ``_top3`` when Numba is not installed"""
+    top3 = np.argpartition(-probs, 3)[:3]
+    return top3[np.argsort(-probs[top3])]
+
+if numba is not None:
+    _top3 = numba.njit(cache=True, fastmath=True)(_top3_kernel)
+    _top3(np.zeros(7, dtype=np.float32))  # compile (or load from cache) at import
+else:
+    _top3 = _top3_numpy
+
+class CalibrationImageReader:
+    """
+    ONNX Runtime calibration data reader over a directory of face crops
+    
+    Implements the ``get_next`` protocol of
+    ``onnxruntime.quantization.CalibrationDataReader``; each image is fed
+    through the detector's own preprocessing so calibration matches inference.
+    """
+    
+    IMAGE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.bmp'})
+    
+    def __init__(self, image_dir, input_name, preprocess, limit=500):
+        """
+        Args:
+            image_dir (str): Directory of face images (e.g. FER-2013 samples)
+            input_name (str): Name of the ONNX model input
+            preprocess (callable): ``(bgr_crop, out) -> out`` filling a
+                float32 (1, 48, 48, 1) buffer
+            limit (int): Maximum number of images to use
+        """
+        self.input_name = input_name
+        self.preprocess = preprocess
+        self.paths = sorted(
+            entry.path for entry in os.scandir(image_dir)
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in self.IMAGE_EXTENSIONS
+        )[:limit]
+        self._iter = iter(self.paths)
+    
+    def get_next(self):
+        """
+        Get the next calibration sample
+        
+        Returns:
+            dict: ``{input_name: (1, 1, 48, 48) float32 array}``, or None when
+                the images are exhausted
+        """
+        for path in self._iter:
+            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            if image is None:
+                continue
+            face = self.preprocess(image, np.empty((1, 48, 48, 1), dtype=np.float32))
+            return {self.input_name: face.reshape(1, 1, 48, 48)}
+        return None
+
 class EmotionDetector:
-    def __init__(self):
-        """Initialize the emotion detector with DeepFace"""
+    # Target rate for adaptive frame skipping
+    TARGET_FPS = 30
+    MAX_FRAME_STRIDE = 10
+    # Skipped frames never reuse a result older than this (seconds)
+    MAX_REUSE_AGE = 1.0
+    # Streams whose gating state is kept (least recently seen are dropped)
+    MAX_STREAMS = 256
+    # Face crops coalesced into one emotion model call
+    MAX_BATCH = 8
+    BATCH_WAIT = 0.005
+    # Seconds a frame waits for its batch before running the model itself
+    BATCH_TIMEOUT = 5.0
+    
+    def __init__(self, frame_stride=None, adaptive_stride=None):
+        """
+        Initialize the emotion detector with DeepFace
+        
+        Args:
+            frame_stride (int): Run the model on every Nth video frame of a
+                stream and reuse that stream's last result for the frames in
+                between; 1 analyzes every frame. Defaults to
+                ``EMOTION_FRAME_STRIDE``, or 1.
+            adaptive_stride (bool): Tune the stride from measured inference
+                latency to keep up with ``TARGET_FPS``. Defaults to
+                ``EMOTION_ADAPTIVE_STRIDE``, or off.
+        """
         self.emotion_labels = ['angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral']
+        self._label_index = {label: i for i, label in enumerate(self.emotion_labels)}
         self.model_name = 'VGG-Face'  # You can also use 'Facenet', 'OpenFace', 'DeepID'
-        self.detector_backend = 'opencv'  # opencv, ssd, dlib, mtcnn, retinaface
+        self.detector_backend = self._select_detector_backend()  # ssd, mediapipe, opencv, dlib, mtcnn, retinaface
         
         # Ensure models directory exists
         os.makedirs('models', exist_ok=True)
         
+        # Fast path for video frames: cached Haar face detector + emotion model,
+        # via TensorRT on GPU when available
+        self._face_cascade = self._load_face_cascade()
+        self._emotion_model = None
+        self._trt_predict = None
+        self._ort_sess = None
+        self._ort_input = None
+        # Numeric precision of the frame path's emotion model
+        self._precision = 'fp32'
+        # Rendered annotation labels keyed by (text, scale, color, thickness)
+        self._label_cache = {}
+        self._preloaded = False
+        
+        # Longest side (px) frames are shrunk to before face detection
+        self._detect_max_side = 320
+        # Run detection-side resize/convert/cascade through OpenCL (T-API) when a device exists
+        self._use_opencl = self._setup_opencl()
+        
+        # Per-thread preprocessing buffers and face cascade, reused across
+        # the frames each request thread handles
+        self._local = threading.local()
+        # Model input of the batching thread
+        self._batch_buf = np.empty((self.MAX_BATCH, 48, 48, 1), dtype=np.float32)
+        
+        # Face crops from concurrent frames share emotion model calls made
+        # on a background thread
+        self._face_queue = queue.Queue()
+        self._batch_thread = None
+        self._batch_thread_lock = threading.Lock()
+        
+        # Decoding and face detection run in parallel on the pool; model calls
+        # are serialized because the Keras graph is not reentrant
+        self._executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='emotion')
+        self._infer_lock = threading.Lock()
+        
+        # Temporal gating for video frames: stream_id -> (frame counter,
+        # last result, monotonic time of the last result)
+        self._streams = OrderedDict()
+        self._streams_lock = threading.Lock()
+        env_stride, env_adaptive = self._select_frame_gating()
+        self._stride = max(1, int(env_stride if frame_stride is None else frame_stride))
+        self._adaptive_stride = env_adaptive if adaptive_stride is None else adaptive_stride
+        self._latency_ema = None
+        
+        # The emotion model and its TensorRT/ONNX backends are built by
+        # ``preload_models`` or, failing that, for the first frame
+        self._inference_ready = False
+        self._setup_lock = threading.Lock()
+        
         logger.info("EmotionDetector initialized successfully")
     
-    def detect_emotion_from_image(self, image_path):
+    @staticmethod
+    def _select_detector_backend():
         """
-        Detect emotions from an image file
+        Pick the DeepFace face detector backend
+        
+        ``EMOTION_DETECTOR_BACKEND`` overrides the choice; otherwise MediaPipe
+        is used when installed and SSD when it is not.
+        
+        Returns:
+            str: DeepFace detector backend name
+        """
+        backend = os.environ.get('EMOTION_DETECTOR_BACKEND', '').strip().lower()
+        if backend:
+            return backend
+        if importlib.util.find_spec('mediapipe') is not None:
+            return 'mediapipe'
+        return 'ssd'
+    
+    @staticmethod
+    def _select_frame_gating():
+        """
+        Read the temporal gating settings for video frames
+        
+        ``EMOTION_FRAME_STRIDE`` sets the frame stride and
+        ``EMOTION_ADAPTIVE_STRIDE=1`` turns on adaptive mode.
+        
+        Returns:
+            tuple: (frame stride, whether the stride adapts to latency)
+        """
+        stride = os.environ.get('EMOTION_FRAME_STRIDE', '').strip()
+        try:
+            stride = int(stride) if stride else 1
+        except ValueError:
+            logger.warning(f"Ignoring invalid EMOTION_FRAME_STRIDE: {stride!r}")
+            stride = 1
+        adaptive = os.environ.get('EMOTION_ADAPTIVE_STRIDE', '').strip().lower() in ('1', 'true')
+        return stride, adaptive
+    
+    @staticmethod
+    def _load_face_cascade():
+        """
+        Load OpenCV's frontal face Haar cascade
+        
+        Returns:
+            cv2.CascadeClassifier: Loaded cascade, or None when this OpenCV
+                build has no cascade support or the XML could not be read
+        """
+        try:
+            cascade = cv2.CascadeClassifier(
+                cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+            )
+            if cascade.empty():
+                raise ValueError("cascade file is empty or missing")
+            return cascade
+            
+        except Exception as e:
+            logger.warning(f"Haar face cascade unavailable, using DeepFace for frames: {str(e)}")
+            return None
+    
+    def _build_emotion_keras_model(self):
+        """
+        Build (or fetch from DeepFace's cache) the Keras emotion classifier
+        
+        Returns:
+            keras.Model: 48x48 grayscale -> 7-way softmax emotion model
+        """
+        try:
+            client = DeepFace.build_model(model_name='Emotion', task='facial_attribute')
+        except TypeError:
+            # DeepFace releases before the ``task`` argument
+            client = DeepFace.build_model('Emotion')
+        return getattr(client, 'model', client)
+    
+    def _load_emotion_model(self):
+        """Build the emotion model once and warm it up with a dummy face"""
+        try:
+            model = self._build_emotion_keras_model()
+            # Prime the graph so the first real frame doesn't pay for tracing
+            model(np.zeros((1, 48, 48, 1), dtype=np.float32), training=False)
+            self._emotion_model = model
+            logger.info("Emotion model loaded")
+            
+        except Exception as e:
+            logger.warning(f"Could not load emotion model, using DeepFace.analyze: {str(e)}")
+            self._emotion_model = None
+    
+    def _setup_inference(self, retry_failed=False):
+        """
+        Build the emotion model and the fastest available backend for it, once
         
         Args:
-            image_path (str): Path to the image file
+            retry_failed (bool): Try again if an earlier attempt left no
+                emotion model, e.g. because the weights could not be downloaded
+        """
+        def needed():
+            return not self._inference_ready or (retry_failed and self._emotion_model is None)
+        
+        if not needed():
+            return
+        with self._setup_lock:
+            if not needed():
+                return
+            # Must happen before the first model touches the GPU
+            self._enable_gpu_memory_growth()
+            self._load_emotion_model()
+            self._setup_gpu_inference()
+            if self._trt_predict is None:
+                self._setup_cpu_inference()
+            self._inference_ready = True
+    
+    @staticmethod
+    def _enable_gpu_memory_growth():
+        """Keep TensorFlow from reserving every GPU's whole memory up front"""
+        try:
+            import tensorflow as tf
+            
+            for gpu in tf.config.list_physical_devices('GPU'):
+                tf.config.experimental.set_memory_growth(gpu, True)
+                
+        except Exception as e:
+            # RuntimeError once TensorFlow has already initialized the GPUs
+            logger.warning(f"Could not enable GPU memory growth: {str(e)}")
+    
+    def _predict_emotions(self, batch):
+        """
+        Run the emotion classifier on preprocessed faces
+        
+        Args:
+            batch (numpy.ndarray): float32 (N, 48, 48, 1) grayscale faces in [0, 1]
             
         Returns:
-            dict: Emotion analysis results
+            numpy.ndarray: (N, 7) probabilities ordered as ``self.emotion_labels``
+        """
+        if self._trt_predict is not None:
+            return self._trt_predict(batch)
+        if self._ort_sess is not None:
+            # With one channel NHWC and NCHW share a memory layout: reshape, no transpose
+            nchw = batch.reshape(batch.shape[0], 1, 48, 48)
+            return self._ort_sess.run(None, {self._ort_input: nchw})[0]
+        # Calling the model directly skips predict()'s per-call dataset setup
+        return np.asarray(self._emotion_model(batch, training=False))
+    
+    def _build_trt_predict(self):
+        """
+        Convert the emotion model to a TensorRT FP16 graph
+        
+        Engines for batches of 1 to ``MAX_BATCH`` faces are built before the
+        converted SavedModel is cached under ``models/``, so neither the
+        conversion nor engine building happens while serving frames.
+        
+        Returns:
+            callable: Maps a float32 (N, 48, 48, 1) batch to (N, 7) probabilities
         """
+        import tensorflow as tf
+        from tensorflow.python.compiler.tensorrt import trt_convert as trt
+        
+        saved_model_dir = os.path.join('models', 'emotion_savedmodel')
+        trt_model_dir = os.path.join('models', 'emotion_trt_fp16')
+        
+        if not os.path.exists(trt_model_dir):
+            logger.info("Converting emotion model to TensorRT FP16...")
+            tf.saved_model.save(self._emotion_model or self._build_emotion_keras_model(), saved_model_dir)
+            converter = trt.TrtGraphConverterV2(
+                input_saved_model_dir=saved_model_dir,
+                precision_mode=trt.TrtPrecisionMode.FP16,
+                max_workspace_size_bytes=1 << 30
+            )
+            converter.convert()
+            
+            def input_fn():
+                # Build engines ahead of time for every batch size the batcher emits
+                for size in range(1, self.MAX_BATCH + 1):
+                    yield (np.zeros((size, 48, 48, 1), dtype=np.float32),)
+            
+            converter.build(input_fn=input_fn)
+            converter.save(trt_model_dir)
+        
+        signature = tf.saved_model.load(trt_model_dir).signatures['serving_default']
+        input_name = next(iter(signature.structured_input_signature[1]))
+        
+        def predict(batch):
+            outputs = signature(**{input_name: tf.constant(batch)})
+            return next(iter(outputs.values())).numpy()
+        
+        # Load the engines now rather than on the first real frame
+        predict(np.zeros((1, 48, 48, 1), dtype=np.float32))
+        return predict
+    
+    def _setup_gpu_inference(self):
+        """Enable the TensorRT frame path when a CUDA GPU is available"""
         try:
-            # Analyze emotions using DeepFace
+            import tensorflow as tf
+            
+            gpus = tf.config.list_physical_devices('GPU')
+            if not gpus:
+                logger.info("No GPU detected, running the emotion model on CPU")
+                return
+            
+            self._trt_predict = self._build_trt_predict()
+            self._precision = 'fp16'
+            logger.info(f"TensorRT FP16 emotion model ready on {len(gpus)} GPU(s)")
+            
+        except Exception as e:
+            logger.warning(f"GPU inference unavailable, running the emotion model on CPU: {str(e)}")
+            self._trt_predict = None
+    
+    def _export_onnx_model(self, onnx_path):
+        """
+        Export the Keras emotion model to an NCHW ONNX graph
+        
+        Args:
+            onnx_path (str): Destination .onnx file
+        """
+        import tensorflow as tf
+        import tf2onnx
+        
+        logger.info("Exporting emotion model to ONNX...")
+        model = self._emotion_model or self._build_emotion_keras_model()
+        tf2onnx.convert.from_keras(
+            model,
+            input_signature=[tf.TensorSpec((None, 48, 48, 1), tf.float32, name='input')],
+            inputs_as_nchw=['input'],
+            output_path=onnx_path
+        )
+    
+    def _quantize_onnx_model(self, onnx_path, int8_path, calibration_dir):
+        """
+        Statically quantize the ONNX emotion model to int8
+        
+        Args:
+            onnx_path (str): fp32 NCHW model
+            int8_path (str): Destination for the quantized model
+            calibration_dir (str): Directory of face images for calibration
+        """
+        import onnxruntime as ort
+        from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+        
+        input_name = ort.InferenceSession(
+            onnx_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+        reader = CalibrationImageReader(calibration_dir, input_name, self._preprocess_face)
+        if not reader.paths:
+            raise ValueError(f"no calibration images in {calibration_dir}")
+        
+        logger.info(f"Quantizing emotion model to int8 with {len(reader.paths)} calibration images...")
+        quantize_static(
+            model_input=onnx_path,
+            model_output=int8_path,
+            calibration_data_reader=reader,
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QInt8,
+            weight_type=QuantType.QInt8
+        )
+    
+    def _setup_cpu_inference(self):
+        """
+        Serve the frame path from ONNX Runtime (OpenVINO when available)
+        
+        An int8 model is used when one is cached under ``models/`` or can be
+        calibrated from the images in ``EMOTION_CALIBRATION_DIR``; otherwise
+        the fp32 export is served. A cached model that fails a dummy run is
+        deleted, so it is rebuilt on the next start, and the Keras model is used.
+        """
+        try:
+            import onnxruntime as ort
+            
+            onnx_path = os.path.join('models', 'emotion_nchw.onnx')
+            if not os.path.exists(onnx_path):
+                self._export_onnx_model(onnx_path)
+            
+            int8_path = os.path.join('models', 'emotion_int8.onnx')
+            calibration_dir = os.environ.get('EMOTION_CALIBRATION_DIR')
+            if not os.path.exists(int8_path) and calibration_dir:
+                try:
+                    self._quantize_onnx_model(onnx_path, int8_path, calibration_dir)
+                except Exception as e:
+                    logger.warning(f"Could not quantize emotion model, using fp32: {str(e)}")
+            
+            if os.path.exists(int8_path):
+                model_path, precision = int8_path, 'int8'
+                providers = ['CPUExecutionProvider']
+            else:
+                model_path, precision = onnx_path, 'fp32'
+                available = ort.get_available_providers()
+                providers = [p for p in ('OpenVINOExecutionProvider', 'CPUExecutionProvider') if p in available]
+            
+            so = ort.SessionOptions()
+            so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            sess = ort.InferenceSession(model_path, sess_options=so, providers=providers)
+            input_name = sess.get_inputs()[0].name
+            try:
+                # A stale or truncated cached export can load yet fail to run
+                probs = sess.run(None, {input_name: np.zeros((1, 1, 48, 48), dtype=np.float32)})[0]
+                if probs.shape != (1, len(self.emotion_labels)):
+                    raise ValueError(f"unexpected output shape {probs.shape}")
+            except Exception:
+                os.remove(model_path)
+                raise
+            self._ort_input = input_name
+            self._ort_sess = sess
+            self._precision = precision
+            logger.info(f"ONNX Runtime {precision} emotion model ready ({providers[0]})")
+            
+        except Exception as e:
+            logger.info(f"ONNX Runtime unavailable, using the Keras emotion model: {str(e)}")
+            self._ort_sess = None
+    
+    @staticmethod
+    def _setup_opencl():
+        """
+        Enable OpenCV's OpenCL backend if a device is available
+        
+        Returns:
+            bool: Whether UMat operations will run on an OpenCL device
+        """
+        try:
+            if not cv2.ocl.haveOpenCL():
+                return False
+            cv2.ocl.setUseOpenCL(True)
+            if not cv2.ocl.useOpenCL():
+                return False
+            logger.info("OpenCL available, using UMat for frame detection")
+            return True
+            
+        except Exception:
+            return False
+    
+    def _downscale_for_detection(self, image, use_opencl=False):
+        """
+        Shrink an image so its longest side is at most ``self._detect_max_side``
+        
+        Args:
+            image (numpy.ndarray): Image to shrink
+            use_opencl (bool): Upload the image and return a ``cv2.UMat``
+            
+        Returns:
+            tuple: (possibly resized image, scale factor applied)
+        """
+        scale = self._detect_max_side / max(image.shape[:2])
+        if use_opencl:
+            image = cv2.UMat(image)
+        if scale >= 1.0:
+            return image, 1.0
+        return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+    
+    def _thread_state(self):
+        """
+        Return the calling thread's preprocessing buffers and face cascade
+        
+        OpenCV cascades are not safe to share between threads, so every
+        request thread loads its own on first use.
+        
+        Returns:
+            threading.local: Holds ``resized``, ``gray``, ``face_input`` and
+                ``cascade`` for this thread
+        """
+        state = self._local
+        if not hasattr(state, 'face_input'):
+            state.resized = np.empty((48, 48, 3), dtype=np.uint8)
+            state.gray = np.empty((48, 48), dtype=np.uint8)
+            state.face_input = np.empty((1, 48, 48, 1), dtype=np.float32)
+            state.cascade = self._load_face_cascade() if self._face_cascade is not None else None
+        return state
+    
+    def _preprocess_face(self, bgr_crop, out):
+        """
+        Convert a BGR face crop into normalized model input in one pass
+        
+        The crop is resized first, so resizing, grayscale conversion and
+        scaling all write into the calling thread's fixed-size buffers and
+        no intermediate arrays are allocated per frame, whatever the crop size.
+        
+        Args:
+            bgr_crop (numpy.ndarray): BGR face crop
+            out (numpy.ndarray): float32 buffer of shape (1, 48, 48, 1)
+            
+        Returns:
+            numpy.ndarray: ``out`` filled with pixel values in [0, 1]
+        """
+        state = self._thread_state()
+        cv2.resize(bgr_crop, (48, 48), dst=state.resized, interpolation=cv2.INTER_LINEAR)
+        cv2.cvtColor(state.resized, cv2.COLOR_BGR2GRAY, dst=state.gray)
+        np.multiply(state.gray, 1.0 / 255.0, out=out[0, ..., 0], casting='unsafe')
+        return out
+    
+    def _locate_face(self, frame):
+        """
+        Find the largest face with the cached Haar cascade
+        
+        Args:
+            frame (numpy.ndarray): BGR video frame
+            
+        Returns:
+            dict: Face region in full-resolution coordinates, or None when
+                no face is found
+        """
+        # Detect on a downscaled copy, then map the box back to full resolution
+        small, scale = self._downscale_for_detection(frame, use_opencl=self._use_opencl)
+        small_gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        cascade = self._thread_state().cascade or self._face_cascade
+        faces = cascade.detectMultiScale(small_gray, scaleFactor=1.1, minNeighbors=5, minSize=(20, 20))
+        
+        if len(faces) == 0:
+            return None
+        x, y, w, h = (int(round(v / scale)) for v in max(faces, key=lambda f: f[2] * f[3]))
+        return {'x': x, 'y': y, 'w': w, 'h': h}
+    
+    def _analyze_frame_deepface(self, frame):
+        """
+        Analyze a frame with DeepFace.analyze when the emotion model is unavailable
+        
+        Args:
+            frame (numpy.ndarray): BGR video frame
+            
+        Returns:
+            tuple: (float32 percentages ordered as ``self.emotion_labels``,
+                index of the dominant emotion, face region)
+        """
+        # Analyze emotions using DeepFace on a downscaled frame
+        small, scale = self._downscale_for_detection(frame)
+        with self._infer_lock:
             result = DeepFace.analyze(
-                img_path=image_path,
+                img_path=small,
                 actions=['emotion'],
                 detector_backend=self.detector_backend,
                 enforce_detection=False
             )
+        
+        # Handle both single face and multiple faces results
+        if isinstance(result, list):
+            result = result[0]  # Take first face if multiple detected
+        
+        probs = self.emotions_to_array(result['emotion'])
+        dominant_idx = self._label_index[result['dominant_emotion']]
+        face_region = dict(result.get('region', {}))
+        # With enforce_detection=False DeepFace reports the whole image when
+        # it finds no face
+        height, width = small.shape[:2]
+        if (face_region.get('x', 0), face_region.get('y', 0),
+                face_region.get('w', width), face_region.get('h', height)) == (0, 0, width, height):
+            face_region = {}
+        
+        # Map the face box back to the original frame
+        for key in ('x', 'y', 'w', 'h'):
+            if key in face_region:
+                face_region[key] = int(round(face_region[key] / scale))
+        for key in ('left_eye', 'right_eye'):
+            if face_region.get(key) is not None:
+                face_region[key] = tuple(int(round(v / scale)) for v in face_region[key])
+        
+        return probs, dominant_idx, face_region
+    
+    def detect_emotion_from_image(self, image_path):
+        """
+        Detect emotions from an image file
+        
+        Args:
+            image_path (str or numpy.ndarray): Path to the image file, or an
+                already decoded BGR image
+            
+        Returns:
+            dict: Emotion analysis results
+        """
+        try:
+            # Analyze emotions using DeepFace
+            with self._infer_lock:
+                result = DeepFace.analyze(
+                    img_path=image_path,
+                    actions=['emotion'],
+                    detector_backend=self.detector_backend,
+                    enforce_detection=False
+                )
             
             # Handle both single face and multiple faces results
             if isinstance(result, list):
@@ -63,7 +691,7 @@ class EmotionDetector:
                 'dominant_emotion': dominant_emotion,
                 'emotions': emotions,
                 'face_region': face_region,
-                'timestamp': datetime.now().isoformat()
+                'timestamp_ns': time.time_ns()
             }
             
         except Exception as e:
@@ -71,115 +699,515 @@ class EmotionDetector:
             return {
                 'success': False,
                 'error': str(e),
-                'timestamp': datetime.now().isoformat()
+                'timestamp_ns': time.time_ns()
+            }
+    
+    def detect_emotion_from_bytes(self, image_bytes):
+        """
+        Detect emotions from an encoded image held in memory
+        
+        Args:
+            image_bytes (bytes): Encoded image (JPEG, PNG, ...)
+            
+        Returns:
+            dict: Emotion analysis results
+        """
+        image = self.decode_image_bytes(image_bytes)
+        if image is None:
+            return {
+                'success': False,
+                'error': 'Could not decode image',
+                'timestamp_ns': time.time_ns()
             }
+        return self.detect_emotion_from_image(image)
     
-    def detect_emotion_from_frame(self, frame):
+    def detect_emotion_from_frame(self, frame, annotate=True, stream_id=None):
         """
         Detect emotions from a video frame (numpy array)
         
+        Face detection, preprocessing and annotation run on the calling
+        thread; only the emotion model call is shared with frames analyzed
+        concurrently on other threads.
+        
         Args:
-            frame (numpy.ndarray): Video frame
+            frame (numpy.ndarray): Video frame; annotations are drawn on it
+                in place
+            annotate (bool): Whether to draw and return the annotated frame
+            stream_id (hashable): Identifies the video stream the frame
+                belongs to; only frames of the same stream may reuse an
+                earlier result. None always analyzes the frame.
             
         Returns:
-            dict: Emotion analysis results with annotated frame
+            dict: Emotion analysis results with annotated frame; ``emotions``
+                is a float32 array ordered as ``self.emotion_labels`` (see
+                ``emotions_to_dict``)
         """
         try:
-            # Analyze emotions using DeepFace
-            result = DeepFace.analyze(
-                img_path=frame,
-                actions=['emotion'],
-                detector_backend=self.detector_backend,
-                enforce_detection=False
-            )
+            self._setup_inference()
+            reused = self._reuse_last_result(frame, annotate, stream_id)
+            if reused is not None:
+                return reused
             
-            # Handle both single face and multiple faces results
-            if isinstance(result, list):
-                result = result[0]  # Take first face if multiple detected
+            started = time.perf_counter()
+            if self._face_cascade is None or (self._trt_predict is None and self._ort_sess is None
+                                              and self._emotion_model is None):
+                probs, dominant_idx, face_region = self._analyze_frame_deepface(frame)
+            else:
+                face_region = self._locate_face(frame)
+                if face_region is not None:
+                    x, y, w, h = face_region['x'], face_region['y'], face_region['w'], face_region['h']
+                    crop = frame[y:y + h, x:x + w]
+                else:
+                    # Match DeepFace with enforce_detection=False: classify the
+                    # whole frame, but report no face region
+                    crop, face_region = frame, {}
+                face_input = self._preprocess_face(crop, self._thread_state().face_input)
+                probs = self._predict_face(face_input)
+                dominant_idx = int(np.argmax(probs))
+            self._update_stride(time.perf_counter() - started)
             
-            emotions = result['emotion']
-            dominant_emotion = result['dominant_emotion']
-            face_region = result.get('region', {})
+            return self._build_frame_result(frame, annotate, stream_id, probs, dominant_idx, face_region)
+        except Exception as e:
+            return self._frame_error(frame, e)
+    
+    def detect_emotion_from_frame_async(self, frame, annotate=True, stream_id=None):
+        """
+        Analyze a video frame on the detector's thread pool
+        
+        Args:
+            frame (numpy.ndarray): Video frame; annotations are drawn on it
+                in place
+            annotate (bool): Whether to draw and return the annotated frame
+            stream_id (hashable): Video stream the frame belongs to, see
+                ``detect_emotion_from_frame``
             
-            # Draw bounding box and emotion label on frame
-            annotated_frame = self.draw_emotion_on_frame(frame, face_region, dominant_emotion, emotions)
+        Returns:
+            concurrent.futures.Future: Resolves to the result dict of
+                ``detect_emotion_from_frame``
+        """
+        return self._executor.submit(self.detect_emotion_from_frame, frame, annotate, stream_id)
+    
+    def submit(self, frame, annotate=True, stream_id=None):
+        """
+        Decode and analyze a frame on the detector's thread pool
+        
+        Decoding, face detection, preprocessing and annotation run
+        concurrently across pool threads. Model calls are serialized: emotion
+        model calls for face crops are batched on the batching thread, and
+        the DeepFace fallback holds the model lock for its whole analysis.
+        From an async Flask or FastAPI handler use
+        ``result = await asyncio.wrap_future(emotion_detector.submit(frame))``
+        so the event loop is not blocked.
+        
+        Args:
+            frame (numpy.ndarray or bytes): Decoded BGR frame, or an encoded
+                image (JPEG, PNG, ...)
+            annotate (bool): Whether to draw and return the annotated frame
+            stream_id (hashable): Video stream the frame belongs to, see
+                ``detect_emotion_from_frame``
             
-            return {
-                'success': True,
-                'dominant_emotion': dominant_emotion,
-                'emotions': emotions,
-                'face_region': face_region,
-                'annotated_frame': annotated_frame,
-                'timestamp': datetime.now().isoformat()
-            }
+        Returns:
+            concurrent.futures.Future: Resolves to the result dict of
+                ``detect_emotion_from_frame``
+        """
+        return self._executor.submit(self._decode_and_detect, frame, annotate, stream_id)
+    
+    def _decode_and_detect(self, frame, annotate, stream_id):
+        """Pool task behind ``submit``"""
+        if not isinstance(frame, np.ndarray):
+            frame = self.decode_image_bytes(frame)
+            if frame is None:
+                return {
+                    'success': False,
+                    'error': 'Could not decode image',
+                    'timestamp_ns': time.time_ns()
+                }
+        return self.detect_emotion_from_frame(frame, annotate, stream_id)
+    
+    def _predict_face(self, face_input):
+        """
+        Run the emotion model on one preprocessed face via the batching thread
+        
+        Crops queued within ``BATCH_WAIT`` seconds of each other (up to
+        ``MAX_BATCH``) share a single model call. If the batch does not
+        complete within ``BATCH_TIMEOUT`` seconds the model is called
+        directly for this face.
+        
+        Args:
+            face_input (numpy.ndarray): float32 model input of shape
+                (1, 48, 48, 1); must not change until this returns
             
+        Returns:
+            numpy.ndarray: Emotion percentages ordered as ``self.emotion_labels``
+        """
+        future = Future()
+        self._start_batch_worker()
+        self._face_queue.put((face_input, future))
+        try:
+            probs = future.result(timeout=self.BATCH_TIMEOUT)
+        except FutureTimeoutError:
+            if not future.cancel():
+                # The batch picked the face up just now; give it a moment more
+                probs = future.result(timeout=self.BATCH_TIMEOUT)
+            else:
+                logger.warning("Emotion batch timed out, running the model directly")
+                with self._infer_lock:
+                    probs = np.asarray(self._predict_emotions(face_input), dtype=np.float32)[0]
+        # Same scaling as DeepFace: percentages summing to 100
+        return probs * (100.0 / probs.sum())
+    
+    def _start_batch_worker(self):
+        """Start the model batching thread if it is not running in this process"""
+        if self._batch_thread is not None and self._batch_thread.is_alive():
+            return
+        with self._batch_thread_lock:
+            if self._batch_thread is None or not self._batch_thread.is_alive():
+                self._batch_thread = threading.Thread(target=self._batch_worker, daemon=True)
+                self._batch_thread.start()
+    
+    def _batch_worker(self):
+        """Collect queued face crops into batches and run the model on them"""
+        while True:
+            pending = [self._face_queue.get()]
+            deadline = time.monotonic() + self.BATCH_WAIT
+            while len(pending) < self.MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._face_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._predict_face_batch(pending)
+    
+    def _predict_face_batch(self, pending):
+        """
+        Run one emotion model call for a batch of queued face crops
+        
+        Runs on the batching thread only, so ``self._batch_buf`` needs no
+        locking.
+        
+        Args:
+            pending (list): (face_input, future) tuples
+        """
+        # Skip crops whose caller already timed out and ran the model itself
+        pending = [(face, future) for face, future in pending if future.set_running_or_notify_cancel()]
+        if not pending:
+            return
+        
+        batch = self._batch_buf[:len(pending)]
+        for slot, (face, _) in enumerate(pending):
+            batch[slot] = face[0]
+        try:
+            with self._infer_lock:
+                probs_batch = np.asarray(self._predict_emotions(batch), dtype=np.float32)
         except Exception as e:
-            logger.error(f"Error detecting emotion from frame: {str(e)}")
-            return {
-                'success': False,
-                'error': str(e),
-                'annotated_frame': frame,
-                'timestamp': datetime.now().isoformat()
-            }
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        for (_, future), probs in zip(pending, probs_batch):
+            future.set_result(probs)
     
-    def draw_emotion_on_frame(self, frame, face_region, dominant_emotion, emotions):
+    def _reuse_last_result(self, frame, annotate, stream_id):
         """
-        Draw emotion information on the frame
+        Return the stream's previous result for frames skipped by temporal gating
+        
+        Args:
+            frame (numpy.ndarray): Video frame
+            annotate (bool): Whether to draw the annotated frame
+            stream_id (hashable): Video stream of the frame, or None
+            
+        Returns:
+            dict: Reused result, or None when this frame must be analyzed
+        """
+        # Emotions don't change between consecutive frames of one stream: only
+        # every ``self._stride``-th frame runs the model, the rest reuse its result
+        if stream_id is None or self._stride == 1:
+            return None
+        with self._streams_lock:
+            state = self._streams.get(stream_id)
+            if state is None:
+                return None
+            counter, last, last_time = state
+            counter += 1
+            self._streams[stream_id] = (counter, last, last_time)
+            self._streams.move_to_end(stream_id)
+            if counter % self._stride == 0 or time.monotonic() - last_time >= self.MAX_REUSE_AGE:
+                return None
+        
+        result = dict(last, reused=True, timestamp_ns=time.time_ns())
+        if annotate:
+            result['annotated_frame'] = self.draw_emotion_on_frame(
+                frame, last['face_region'], last['dominant_emotion'], last['emotions'])
+        return result
+    
+    def _build_frame_result(self, frame, annotate, stream_id, probs, dominant_idx, face_region):
+        """
+        Build the result dict for an analyzed frame and remember it for reuse
         
         Args:
-            frame (numpy.ndarray): Original frame
+            frame (numpy.ndarray): Video frame
+            annotate (bool): Whether to draw the annotated frame
+            stream_id (hashable): Video stream of the frame, or None
+            probs (numpy.ndarray): Emotion percentages
+            dominant_idx (int): Index of the dominant emotion
             face_region (dict): Face bounding box coordinates
-            dominant_emotion (str): Dominant emotion
-            emotions (dict): All emotion probabilities
             
         Returns:
-            numpy.ndarray: Annotated frame
+            dict: Emotion analysis results
+        """
+        dominant_emotion = self.emotion_labels[dominant_idx]
+        result = {
+            'success': True,
+            'dominant_emotion': dominant_emotion,
+            'emotions': probs,
+            'face_region': face_region,
+            'timestamp_ns': time.time_ns()
+        }
+        if stream_id is not None and self._stride > 1:
+            # Restart the stream's count at the analyzed frame
+            with self._streams_lock:
+                self._streams[stream_id] = (0, dict(result), time.monotonic())
+                self._streams.move_to_end(stream_id)
+                while len(self._streams) > self.MAX_STREAMS:
+                    self._streams.popitem(last=False)
+        
+        # Draw bounding box and emotion label on frame
+        if annotate:
+            result['annotated_frame'] = self.draw_emotion_on_frame(frame, face_region, dominant_emotion, probs)
+        
+        return result
+    
+    def _frame_error(self, frame, error):
+        """Build the failure result for a frame that could not be analyzed"""
+        logger.error(f"Error detecting emotion from frame: {str(error)}")
+        return {
+            'success': False,
+            'error': str(error),
+            'annotated_frame': frame,
+            'timestamp_ns': time.time_ns()
+        }
+    
+    def emotions_to_array(self, emotions):
         """
-        annotated_frame = frame.copy()
+        Convert an emotion -> score mapping into a float32 array
         
-        if face_region:
-            x, y, w, h = face_region.get('x', 0), face_region.get('y', 0), \
-                        face_region.get('w', 0), face_region.get('h', 0)
+        Args:
+            emotions (dict): Emotion scores keyed by label, as from DeepFace
             
-            # Draw bounding box
-            cv2.rectangle(annotated_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+        Returns:
+            numpy.ndarray: Scores ordered as ``self.emotion_labels``
+        """
+        probs = np.zeros(len(self.emotion_labels), dtype=np.float32)
+        for label, score in emotions.items():
+            probs[self._label_index[label]] = score
+        return probs
+    
+    def emotions_to_dict(self, probs):
+        """
+        Convert a float32 emotion array back into a JSON-friendly dict
+        
+        Args:
+            probs (numpy.ndarray): Scores ordered as ``self.emotion_labels``
             
-            # Draw dominant emotion label
-            label = f"{dominant_emotion}: {emotions[dominant_emotion]:.1f}%"
-            cv2.putText(annotated_frame, label, (x, y - 10), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
+        Returns:
+            dict: Emotion scores keyed by label
+        """
+        return dict(zip(self.emotion_labels, probs.tolist()))
+    
+    def _update_stride(self, latency):
+        """
+        Track inference latency and, in adaptive mode, retune the frame stride
+        
+        Args:
+            latency (float): Duration of the last full analysis in seconds
+        """
+        with self._streams_lock:
+            if self._latency_ema is None:
+                self._latency_ema = latency
+            else:
+                self._latency_ema = 0.8 * self._latency_ema + 0.2 * latency
             
-            # Draw top 3 emotions
-            sorted_emotions = sorted(emotions.items(), key=lambda x: x[1], reverse=True)[:3]
-            for i, (emotion, confidence) in enumerate(sorted_emotions):
-                text = f"{emotion}: {confidence:.1f}%"
-                cv2.putText(annotated_frame, text, (x, y + h + 25 + i * 25), 
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+            if self._adaptive_stride:
+                # One full analysis per stride frames keeps up with TARGET_FPS
+                stride = math.ceil(self._latency_ema * self.TARGET_FPS)
+                self._stride = min(max(stride, 1), self.MAX_FRAME_STRIDE)
+    
+    def _get_label_tile(self, text, font_scale, color, thickness):
+        """
+        Get a pre-rendered text label, rendering it on first use
+        
+        Args:
+            text (str): Label text
+            font_scale (float): cv2.putText font scale
+            color (tuple): BGR text color
+            thickness (int): Stroke thickness
+            
+        Returns:
+            tuple: (BGR tile, boolean text mask, x offset, y offset of the baseline)
+        """
+        key = (text, font_scale, color, thickness)
+        tile = self._label_cache.get(key)
+        if tile is None:
+            (text_w, text_h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+            pad = thickness
+            image = np.zeros((text_h + baseline + 2 * pad, text_w + 2 * pad, 3), dtype=np.uint8)
+            cv2.putText(image, text, (pad, text_h + pad), cv2.FONT_HERSHEY_SIMPLEX, font_scale, color, thickness)
+            tile = (image, image.any(axis=2), pad, text_h + pad)
+            self._label_cache[key] = tile
+        return tile
+    
+    def _blit_label(self, frame, tile, org):
+        """
+        Copy a pre-rendered label onto the frame, clipped to its bounds
+        
+        Args:
+            frame (numpy.ndarray): Frame to draw on (modified in place)
+            tile (tuple): Label from ``_get_label_tile``
+            org (tuple): Bottom-left text origin, as for cv2.putText
+        """
+        image, mask, offset_x, offset_y = tile
+        x0, y0 = org[0] - offset_x, org[1] - offset_y
+        frame_h, frame_w = frame.shape[:2]
+        
+        # Part of the tile that lands inside the frame
+        tx0, ty0 = max(0, -x0), max(0, -y0)
+        tx1 = min(image.shape[1], frame_w - x0)
+        ty1 = min(image.shape[0], frame_h - y0)
+        if tx1 <= tx0 or ty1 <= ty0:
+            return
+        
+        np.copyto(frame[y0 + ty0:y0 + ty1, x0 + tx0:x0 + tx1],
+                  image[ty0:ty1, tx0:tx1],
+                  where=mask[ty0:ty1, tx0:tx1, np.newaxis])
+    
+    def _draw_label(self, frame, text, font_scale, color, thickness, org):
+        """
+        Draw a text label, blitting the cached tile on host frames
+        
+        Args:
+            frame (numpy.ndarray or cv2.UMat): Frame to draw on (modified in place)
+            text (str): Label text
+            font_scale (float): cv2.putText font scale
+            color (tuple): BGR text color
+            thickness (int): Stroke thickness
+            org (tuple): Bottom-left text origin
+        """
+        if isinstance(frame, cv2.UMat):
+            # Device frames can't be sliced; let OpenCV draw on them
+            cv2.putText(frame, text, org, cv2.FONT_HERSHEY_SIMPLEX, font_scale, color, thickness)
+        else:
+            self._blit_label(frame, self._get_label_tile(text, font_scale, color, thickness), org)
+    
+    def draw_emotion_on_frame(self, frame, face_region, dominant_emotion, probs, inplace=True):
+        """
+        Draw emotion information on the frame
+        
+        Labels show whole percentages so their rendered tiles can be cached
+        and reused across frames.
+        
+        Args:
+            frame (numpy.ndarray or cv2.UMat): Original frame
+            face_region (dict): Face bounding box coordinates
+            dominant_emotion (str): Dominant emotion
+            probs (numpy.ndarray): All emotion probabilities, ordered as
+                ``self.emotion_labels``
+            inplace (bool): Draw directly on ``frame`` instead of a copy; a
+                frame without a face region is returned uncopied either way
+            
+        Returns:
+            numpy.ndarray or cv2.UMat: Annotated frame, of the same type as ``frame``
+        """
+        # Nothing to draw: hand the frame back without copying it
+        if not face_region:
+            return frame
+        
+        if inplace:
+            annotated_frame = frame
+        elif isinstance(frame, cv2.UMat):
+            annotated_frame = cv2.UMat(frame.get())
+        else:
+            annotated_frame = frame.copy()
+        
+        x, y, w, h = int(face_region.get('x', 0)), int(face_region.get('y', 0)), \
+                    int(face_region.get('w', 0)), int(face_region.get('h', 0))
+        
+        # Draw bounding box
+        cv2.rectangle(annotated_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+        
+        # Draw dominant emotion label
+        label = f"{dominant_emotion}: {probs[self._label_index[dominant_emotion]]:.0f}%"
+        self._draw_label(annotated_frame, label, 0.9, (0, 255, 0), 2, (x, y - 10))
+        
+        # Draw top 3 emotions
+        for i, idx in enumerate(_top3(probs)):
+            text = f"{self.emotion_labels[idx]}: {probs[idx]:.0f}%"
+            self._draw_label(annotated_frame, text, 0.6, (255, 255, 255), 1, (x, y + h + 25 + i * 25))
         
         return annotated_frame
     
-    def base64_to_image(self, base64_string):
+    def decode_image_bytes(self, image_bytes):
         """
-        Convert base64 string to PIL Image
+        Decode an encoded image to a BGR numpy array
+        
+        JPEGs are decoded with libjpeg-turbo (simplejpeg) when available,
+        anything else goes through OpenCV.
         
         Args:
-            base64_string (str): Base64 encoded image
+            image_bytes (bytes): Encoded image
             
         Returns:
-            PIL.Image: Decoded image
+            numpy.ndarray: Decoded BGR image, or None if decoding failed
         """
+        if not image_bytes:
+            return None
+        if simplejpeg is not None:
+            try:
+                return simplejpeg.decode_jpeg(image_bytes, colorspace='BGR')
+            except ValueError:
+                pass  # Not a JPEG (e.g. PNG); let OpenCV handle it
         try:
-            # Remove data URL prefix if present
-            if ',' in base64_string:
-                base64_string = base64_string.split(',')[1]
+            nparr = np.frombuffer(image_bytes, np.uint8)
+            return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        except cv2.error as e:
+            logger.error(f"Error decoding image: {str(e)}")
+            return None
+    
+    def encode_jpeg(self, frame, quality=75):
+        """
+        Encode a BGR frame as JPEG
+        
+        Args:
+            frame (numpy.ndarray): BGR image
+            quality (int): JPEG quality (0-100)
             
-            # Decode base64 to bytes
-            image_bytes = base64.b64decode(base64_string)
+        Returns:
+            bytes: Encoded JPEG
+        """
+        if simplejpeg is not None:
+            return simplejpeg.encode_jpeg(np.ascontiguousarray(frame), quality=quality, colorspace='BGR')
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return buffer.tobytes()
+    
+    def base64_to_ndarray(self, base64_string):
+        """
+        Convert a base64 string (optionally a data URL) to a BGR numpy array
+        
+        Decodes straight to an OpenCV-compatible array, without going
+        through PIL.
+        
+        Args:
+            base64_string (str): Base64 encoded image
             
-            # Convert to PIL Image
-            image = Image.open(io.BytesIO(image_bytes))
+        Returns:
+            numpy.ndarray: Decoded BGR image, or None if decoding failed
+        """
+        try:
+            # Remove data URL prefix if present; the header is short
+            if base64_string.startswith('data:'):
+                base64_string = base64_string[base64_string.find(',', 0, 64) + 1:]
             
-            return image
+            return self.decode_image_bytes(pybase64.b64decode(base64_string, validate=False))
             
         except Exception as e:
             logger.error(f"Error converting base64 to image: {str(e)}")
@@ -187,18 +1215,24 @@ class EmotionDetector:
     
     def image_to_base64(self, image):
         """
-        Convert PIL Image to base64 string
+        Convert an image to a base64 JPEG data URL
         
         Args:
-            image (PIL.Image): Image to convert
+            image (numpy.ndarray or PIL.Image): BGR array, or an RGB PIL image
             
         Returns:
             str: Base64 encoded image
         """
         try:
-            buffer = io.BytesIO()
-            image.save(buffer, format='JPEG')
-            image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            if isinstance(image, np.ndarray):
+                arr = image
+            else:
+                arr = cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+            ok, encoded = cv2.imencode('.jpg', arr, [int(cv2.IMWRITE_JPEG_QUALITY), 85,
+                                                     int(cv2.IMWRITE_JPEG_OPTIMIZE), 0])
+            if not ok:
+                raise ValueError("JPEG encoding failed")
+            image_base64 = pybase64.b64encode(encoded).decode('ascii')
             return f"data:image/jpeg;base64,{image_base64}"
             
         except Exception as e:
@@ -208,14 +1242,32 @@ class EmotionDetector:
     def preload_models(self):
         """
         Preload DeepFace models to improve performance
+        
+        Builds and warms up the emotion model (which DeepFace.analyze shares
+        through its model cache) and its TensorRT or ONNX Runtime backend;
+        a load that failed earlier, e.g. because the weights could not be
+        downloaded, is retried. The face detector is warmed with two dummy
+        analyses: the first one downloads and parses the detector weights,
+        the second one runs warm. Once this has succeeded, later calls
+        return immediately.
         """
+        if self._preloaded:
+            return
+        
+        if self._face_cascade is None:
+            self._face_cascade = self._load_face_cascade()
+        logger.info("Preloading DeepFace models...")
+        self._setup_inference(retry_failed=True)
+        
         try:
-            logger.info("Preloading DeepFace models...")
-            # Create a dummy image to trigger model loading
+            logger.info(f"Warming up the '{self.detector_backend}' face detector...")
             dummy_img = np.zeros((224, 224, 3), dtype=np.uint8)
-            DeepFace.analyze(dummy_img, actions=['emotion'], 
-                           detector_backend=self.detector_backend, 
-                           enforce_detection=False)
+            for _ in range(2):
+                with self._infer_lock:
+                    DeepFace.analyze(dummy_img, actions=['emotion'],
+                                     detector_backend=self.detector_backend,
+                                     enforce_detection=False)
+            self._preloaded = self._emotion_model is not None
             logger.info("Models preloaded successfully")
             
         except Exception as e:
@@ -223,3 +1275,11 @@ class EmotionDetector:
 
 # Create global instance
 emotion_detector = EmotionDetector()
+
+# Load and warm the models at import so the first request does not pay for it;
+# EMOTION_SKIP_PRELOAD=1 defers all model loading to first use
+if os.environ.get('EMOTION_SKIP_PRELOAD') != '1':
+    try:
+        emotion_detector.preload_models()
+    except Exception as e:
+        logger.warning(f"Could not preload models at import: {str(e)}")
@@ -0,0 +1,33 @@
+"""
+Gunicorn configuration for the Facial Emotion Recognition System
+Run with: gunicorn app:app
+"""
+
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Threaded workers: request threads mostly wait on TensorFlow, OpenCV and
+# base64/JPEG codecs, which release the GIL.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4 * (os.cpu_count() or 1)))
+
+# The JSON database keeps its indices, recent records and statistics in
+# process memory, so a single worker process should own the data files.
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+
+# Keep webcam clients' connections open between frames
+keepalive = 5
+timeout = 120
+
+# Workers import the app themselves (TensorFlow is not fork-safe, so it is
+# never loaded in the master). Model loading is left out of that import, which
+# would otherwise block the worker past ``timeout``, and runs in
+# post_worker_init instead.
+os.environ['EMOTION_SKIP_PRELOAD'] = '1'
+
+
+def post_worker_init(worker):
+    """Warm up the emotion models in the background once the worker is up"""
+    import app
+    app.preload_models()
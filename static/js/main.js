@@ -11,6 +11,10 @@ class EmotionRecognitionApp {
         this.stream = null;
         this.isDetecting = false;
         this.detectionInterval = null;
+        // Identifies this tab's webcam stream so the server can reuse
+        // results across its consecutive frames
+        this.streamId = window.crypto?.randomUUID?.() ??
+            `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
         
         this.init();
     }
@@ -194,7 +198,8 @@ class EmotionRecognitionApp {
                 },
                 body: JSON.stringify({
                     image: imageData,
-                    save_to_db: saveToDb
+                    save_to_db: saveToDb,
+                    stream_id: this.streamId
                 })
             });
             